@@ -1,22 +1,48 @@
+import functools
+import math
 import os
 from typing import Dict, List
 
+import numpy as np
 import torch
 import torch_npu
-from torch_npu.contrib import transfer_to_npu
+try:
+    # monkey-patches torch.cuda onto NPU for third-party code that hardcodes
+    # cuda; our own hot paths call torch.npu directly to skip the shim
+    from torch_npu.contrib import transfer_to_npu  # noqa: F401
+except ImportError:
+    pass
 from llm_perf.core.generation import GenerateRequest
 from llm_perf.core.engine import CoreEngine
-from llm_perf.backends.NPU.npu_process_messager import NPUMultiProcessMsgr
 from llm_perf.utils.logger import logger
 
 
+@functools.lru_cache(maxsize=32)
+def _host_input_block(batch_size: int, seq_len: int) -> np.ndarray:
+    # steady-state serving revisits a small set of (B, S) shapes, decode
+    # especially pins (B, 1); reuse one host block per shape instead of
+    # reallocating each step. prepare_inputs fully overwrites the block and
+    # the single-threaded scheduler loop consumes it before the next step.
+    return np.empty((2, batch_size, seq_len), dtype=np.int64)
+
+
 class NpuEngine(CoreEngine):
-    
+
+    # generate_type <-> int code, for tensor-based input broadcast
+    GENERATE_TYPE_CODES = {"": 0, "prefill": 1, "decode": 2}
+    GENERATE_TYPE_NAMES = {v: k for k, v in GENERATE_TYPE_CODES.items()}
+
     class Packet(CoreEngine.Packet):
         def __init__(self, request: GenerateRequest):
             CoreEngine.Packet.__init__(self, request)
 
             self.generation_start_time = None
+            # cached len(input_ids) + len(generate_ids), kept current by add_result
+            self._cur_len = len(request.input_ids)
+
+        def add_result(self, res) -> None:
+            CoreEngine.Packet.add_result(self, res)
+            self._cur_len += 1
 
         def _is_finished(self) -> bool:
             return self.is_finished()
@@ -26,62 +52,57 @@ class NpuEngine(CoreEngine):
             batch: List[CoreEngine.Packet],
             **kwargs
         ) -> Dict:
-            model_config = kwargs["model_config"]
-            pad_token_id = kwargs["pad_token_id"] 
-
-            all_input_ids = []
-            all_position_ids = []
-
-            max_seq_len = -1
-            for packet in batch:
-                cur_id_len = len(packet.request.input_ids) + len(packet.generate_ids)
-                max_seq_len = cur_id_len if cur_id_len > max_seq_len else max_seq_len
-
-            for packet in batch:
-                cur_id_len = len(packet.request.input_ids) + len(packet.generate_ids)
-                pad_len = max_seq_len - cur_id_len
-                # input_ids = (
-                #     packet.request.input_ids + 
-                #     packet.generate_ids + 
-                #     [pad_token_id] * pad_len
-                # )
-                generate_type = ""
-                if len(packet.generate_ids) == 0:
-                    input_ids = (
-                        packet.request.input_ids + 
-                        packet.generate_ids + 
-                        [pad_token_id] * pad_len
+            pad_token_id = kwargs["pad_token_id"]
+            return_last_logit = kwargs["return_last_logit"]
+
+            cur_lens = np.fromiter(
+                (packet._cur_len for packet in batch), dtype=np.int64, count=len(batch)
+            )
+            max_seq_len = int(cur_lens.max())
+
+            # per-row prefill mask, so a batch may mix prefill and decode packets.
+            # a mixed batch runs as a full-sequence forward, decode rows included,
+            # since decode rows lose their kv cache once any row needs prefill.
+            is_prefill = np.array(
+                [len(packet.generate_ids) == 0 for packet in batch], dtype=bool
+            )
+            any_prefill = bool(is_prefill.any())
+
+            # preallocate one (2, B, S) block, plane 0 input_ids and plane 1
+            # position_ids, so both move to device in a single transfer.
+            # an all-decode batch only carries the last token and its position
+            # per row, the model expands from column 0 on decode.
+            # fill rows with slice assignment
+            seq_dim = max_seq_len if any_prefill else 1
+            block = _host_input_block(len(batch), seq_dim)
+            input_arr = block[0]
+            pos_arr = block[1]
+            input_arr.fill(pad_token_id)
+            pos_arr.fill(0)
+
+            for i, packet in enumerate(batch):
+                if is_prefill[i] or any_prefill:
+                    cur_id_len = cur_lens[i]
+                    input_arr[i, :cur_id_len] = np.asarray(
+                        packet.request.input_ids + packet.generate_ids, dtype=np.int64
                     )
-                    all_position_ids.append([i for i in range(max_seq_len)])
-                    generate_type = "prefill"
+                    pos_arr[i] = np.arange(max_seq_len, dtype=np.int64)
                 else:
-                    # input_ids = ([packet.generate_ids[len(packet.generate_ids) - 1]])
-
-                    input_ids = ([packet.generate_ids[len(packet.generate_ids) - 1]] + [pad_token_id] * (max_seq_len - 1))
-
-                    # input_ids = (
-                    #     packet.request.input_ids + 
-                    #     packet.generate_ids + 
-                    #     [pad_token_id] * pad_len
-                    # )
-                    all_position_ids.append([max_seq_len - 1] + [0] * (max_seq_len - 1))
-                    generate_type = "decode"
-                # print(f"input_ids ------ {input_ids}")
-                all_input_ids.append(input_ids)
-                # all_position_ids.append([i for i in range(max_seq_len)])
-
-            # breakpoint()
+                    input_arr[i, 0] = packet.generate_ids[-1]
+                    pos_arr[i, 0] = max_seq_len - 1
+
             model_inputs = {
-                "past_key_values": None, 
-                "attention_mask": None, 
+                "past_key_values": None,
+                "attention_mask": None,
                 "use_cache": None
             }
-            model_inputs["input_ids"] = all_input_ids
-            model_inputs["position_ids"] = all_position_ids
-            model_inputs["generate_type"] = generate_type
+            model_inputs["input_block"] = block
+            model_inputs["is_prefill"] = is_prefill
+            # per-row index of the last real token, rows are right-padded
+            model_inputs["last_token_index"] = cur_lens - 1
+            model_inputs["generate_type"] = "prefill" if any_prefill else "decode"
 
-            model_name = model_config['model_name']
-            if model_name == 'chatglm2':
+            if return_last_logit:
                 model_inputs["return_last_logit"] = False
             return model_inputs
 
@@ -95,68 +116,153 @@ class NpuEngine(CoreEngine):
 
         self.model_config = model_config
         self.pad_token_id = pad_token_id
-        
+
+        # precomputed once, only chatglm2 takes the extra forward kwarg
+        self._return_last_logit = model_config["model_name"] == "chatglm2"
+
+        # reusable pinned host buffer for H2D staging, grown on demand
+        self._pinned_inputs = None
+
+        # persistent device-side input buffer, grown on demand
+        self._dev_inputs = None
+
         # set up environ
         self.setup()
-        
-        # init multiprocessr msgr
-        if self.world_size > 1:
-            self.mlp_manager = NPUMultiProcessMsgr(
-                self.local_rank, self.world_size, "MultiProcessMsgr"
-            )
-    
+
     def setup(self):
         # init distributed env if needed
         self.world_size = int(os.environ.get("WORLD_SIZE", "1"))
         self.local_rank = int(os.environ.get("LOCAL_RANK", "0"))
         if self.world_size > 1:
             torch.distributed.init_process_group(
-                backend="nccl", 
-                world_size=self.world_size, 
+                backend="nccl",
+                world_size=self.world_size,
                 rank=self.local_rank
             )
 
+        # bind device once per process, not per inference step
+        torch.npu.set_device(self.local_rank)
+
+        # dedicated stream for H2D copies, so input transfer overlaps the
+        # tail of the previous forward on the compute stream
+        self._copy_stream = torch.npu.Stream()
+        self._copy_done = torch.npu.Event()
+
         # load model using base method
         self.model = NpuEngine.load_model(self.model_config, "NPU")
 
 
-    def broadcast_inputs(self, *args):
+    def broadcast_inputs(self, model_inputs):
         if self.world_size <= 1:
-            return args
-        
+            return model_inputs
+
         if self.local_rank == 0:
-            self.mlp_manager.broadcast(args)
-            return args
+            input_block = model_inputs["input_block"]
+            # shape / flag metadata first, as a small device tensor
+            meta = torch.tensor(
+                [
+                    input_block.size(1),
+                    input_block.size(2),
+                    NpuEngine.GENERATE_TYPE_CODES[model_inputs["generate_type"]],
+                    1 if "return_last_logit" in model_inputs else 0,
+                ],
+                dtype=torch.int64, device="npu",
+            )
+            torch.distributed.broadcast(meta, src=0)
+            torch.distributed.broadcast(input_block, src=0)
+            return model_inputs
         else:
-            inputs = self.mlp_manager.receive()
-            return inputs
+            meta = torch.empty(4, dtype=torch.int64, device="npu")
+            torch.distributed.broadcast(meta, src=0)
+            batch_size, seq_len, type_code, last_logit_flag = meta.tolist()
+
+            # prefix view of the persistent buffer is contiguous, receive in place
+            input_block = self._device_buffer("_dev_inputs", (2, batch_size, seq_len))
+            torch.distributed.broadcast(input_block, src=0)
+
+            model_inputs = {
+                "past_key_values": None,
+                "attention_mask": None,
+                "use_cache": None,
+                "input_block": input_block,
+                "generate_type": NpuEngine.GENERATE_TYPE_NAMES[type_code],
+            }
+            if last_logit_flag:
+                model_inputs["return_last_logit"] = False
+            return model_inputs
+
+
+    def _stage_to_pinned(self, buf_name: str, arr) -> torch.Tensor:
+        # copy a host array into a flat persistent pinned buffer. monotonic
+        # growth by element count converges under fluctuating batch/seq shapes,
+        # and the contiguous prefix view keeps the H2D copy a single DMA
+        shape = tuple(arr.shape)
+        numel = math.prod(shape)
+        buf = getattr(self, buf_name)
+        if buf is None or buf.numel() < numel:
+            buf = torch.empty(numel, dtype=torch.int64, pin_memory=True)
+            setattr(self, buf_name, buf)
+        view = buf[:numel].view(shape)
+        view.copy_(torch.as_tensor(arr))
+        return view
+
+
+    def _device_buffer(self, buf_name: str, shape) -> torch.Tensor:
+        # contiguous prefix view into a flat persistent device buffer. flat
+        # storage grows monotonically, so once sized every shape up to the max
+        # is served in place without allocation
+        shape = tuple(shape)
+        numel = math.prod(shape)
+        buf = getattr(self, buf_name)
+        if buf is None or buf.numel() < numel:
+            buf = torch.empty(numel, dtype=torch.int64, device="npu")
+            setattr(self, buf_name, buf)
+        return buf[:numel].view(shape)
+
+
+    def _stage_to_device(self, buf_name: str, host_tensor: torch.Tensor) -> torch.Tensor:
+        # async copy into a persistent device buffer instead of allocating per step
+        view = self._device_buffer(buf_name, host_tensor.shape)
+        view.copy_(host_tensor, non_blocking=True)
+        return view
 
 
     def prepare_inputs(self, batch: List[CoreEngine.Packet]) -> Dict:
         model_inputs = NpuEngine.Packet.prepare_inputs(
-            batch, 
-            model_config=self.model_config, 
-            pad_token_id=self.pad_token_id
+            batch,
+            pad_token_id=self.pad_token_id,
+            return_last_logit=self._return_last_logit
         )
         return model_inputs
 
 
+    @torch.inference_mode()
     def do_inference(self, packets: List[CoreEngine.Packet]):
-        # set device
-        torch.cuda.set_device(self.local_rank)
+        # rank 0 prepares and stages inputs on device, other ranks receive via collective
+        if self.local_rank == 0:
+            model_inputs = self.prepare_inputs(packets)
+            # row mask and last-token index are host-side info, not model inputs
+            model_inputs.pop("is_prefill")
+            last_token_index = model_inputs.pop("last_token_index")
 
-        # prepare inputs for each process
-        model_inputs = self.prepare_inputs(packets) if self.local_rank == 0 else None
-        model_inputs = self.broadcast_inputs(model_inputs)[0]
+            # make sure last step's async copy drained before reusing the pinned buffer
+            self._copy_done.synchronize()
 
-        # convert inputs to torch tensor
-        model_inputs["input_ids"] = torch.tensor(model_inputs["input_ids"])
-        model_inputs["position_ids"] = torch.tensor(model_inputs["position_ids"])
+            # stage the input block in pinned memory, then one async copy to
+            # device on the copy stream; compute stream waits on the event
+            host_block = self._stage_to_pinned("_pinned_inputs", model_inputs["input_block"])
+            with torch.npu.stream(self._copy_stream):
+                model_inputs["input_block"] = self._stage_to_device("_dev_inputs", host_block)
+            self._copy_done.record(self._copy_stream)
+            torch.npu.current_stream().wait_event(self._copy_done)
+        else:
+            model_inputs = None
+        model_inputs = self.broadcast_inputs(model_inputs)
 
-        # cpu to cuda
-        for k, v in model_inputs.items():
-            if isinstance(v, torch.Tensor):
-                model_inputs[k] = v.cuda()
+        # split the coalesced block back into its two model inputs
+        input_block = model_inputs.pop("input_block")
+        model_inputs["input_ids"] = input_block[0]
+        model_inputs["position_ids"] = input_block[1]
 
         # model forward
         outputs = self.model(**model_inputs)
@@ -164,13 +270,36 @@ class NpuEngine(CoreEngine):
         # rank 0: return logits
         # other rank: return
         if self.local_rank == 0:
-            input_logits = outputs.logits[..., :-1, :].contiguous()
-            next_tokens_logits = outputs.logits[:, -1, :].contiguous()
+            # sampling only needs each row's last real token. decode logits are
+            # (B, 1, V) so the last column is it; full-sequence batches are
+            # right-padded per row, so gather at every row's own last index
+            if model_inputs["generate_type"] == "decode":
+                next_tokens_logits = outputs.logits[:, -1, :]
+            else:
+                row_index = torch.arange(
+                    outputs.logits.size(0), device=outputs.logits.device
+                )
+                col_index = torch.as_tensor(
+                    last_token_index, device=outputs.logits.device
+                )
+                next_tokens_logits = outputs.logits[row_index, col_index]
+
+            # hand it out in fp16 to halve bandwidth on this hot tensor,
+            # sampling upcasts internally
+            if next_tokens_logits.dtype == torch.float32:
+                next_tokens_logits = next_tokens_logits.half()
+
+            # decode steps never consume input logits, skip the (B, S-1, V) copy.
+            # prefill keeps a non-contiguous view, consumers handle strides.
+            if model_inputs["generate_type"] == "decode":
+                input_logits = None
+            else:
+                input_logits = outputs.logits[..., :-1, :]
 
             logger.debug(
                 f"tensor shape: {outputs.logits.shape}\n"
                 f"next tokens logits: {next_tokens_logits.shape}\n"
-                f"input logits: {input_logits.shape}\n"
+                f"input logits: {input_logits.shape if input_logits is not None else None}\n"
             )
 
             return {
@@ -69,8 +69,6 @@ class NpuSampler(CoreSampler):
         max_seqlens: int = 0,
     ) -> Tuple[List[int], torch.FloatTensor]:
         _is_greedy = False
-        _is_random = False
-        _is_fastpath = False
 
         if top_k:
             assert all(
@@ -78,12 +76,7 @@ class NpuSampler(CoreSampler):
             ), f"expect the same batch top_k, but got {top_k}"
             if all(k == 1 for k in top_k):
                 _is_greedy = True
-        elif top_p:
-            _is_random = True
-            if all(p == top_p[0] for p in top_p):
-                _is_fastpath = True
-                _top_p = top_p[0]
-        else:
+        elif not top_p:
             raise RuntimeError(
                 f"Unsupported sample strategy, parameter top_k: {top_k} top_p: {top_p}"
             )
@@ -92,8 +85,31 @@ class NpuSampler(CoreSampler):
             return torch.argmax(logits, dim=-1), torch.nn.functional.softmax(
                 logits, dim=-1
             )
-        else:
-            raise NotImplementedError
+
+        # random sampling: filter and sample the whole batch with device-wide
+        # ops, one multinomial launch instead of a per-request python loop
+        if temperature:
+            t = torch.as_tensor(temperature, dtype=logits.dtype, device=logits.device)
+            logits = logits / t.unsqueeze(1)
+
+        if top_k:
+            kth_logit = torch.topk(logits, top_k[0], dim=-1).values[..., -1, None]
+            logits = logits.masked_fill(logits < kth_logit, float("-inf"))
+
+        if top_p:
+            p = torch.as_tensor(top_p, dtype=logits.dtype, device=logits.device)
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+            cum_probs = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+            sorted_remove = cum_probs > p.unsqueeze(1)
+            # shift right so the first token above the threshold is kept
+            sorted_remove[..., 1:] = sorted_remove[..., :-1].clone()
+            sorted_remove[..., :min_tokens_to_keep] = False
+            remove = sorted_remove.scatter(1, sorted_indices, sorted_remove)
+            logits = logits.masked_fill(remove, float("-inf"))
+
+        softmax_out = torch.nn.functional.softmax(logits, dim=-1)
+        next_tokens = torch.multinomial(softmax_out, num_samples=1).squeeze(1)
+        return next_tokens, softmax_out
 
     def postprocess(
         self,
@@ -118,12 +134,17 @@ class NpuSampler(CoreSampler):
 
             if packet.request.generate_config.get_input_logits:
                 last_logits = infer_outputs["last_logits"]
+                # decode steps carry no input logits, and the engine hands out
+                # non-contiguous slices, so flatten with reshape instead of view
                 input_logits = infer_outputs["input_logits"]
                 gen_res = GenerateResult(
                     token_id=token_id,
                     finish_reason=finish_reason,
-                    last_logits=last_logits.view(-1).tolist(),
-                    input_logits=input_logits.view(-1).tolist(),
+                    last_logits=last_logits.reshape(-1).tolist(),
+                    input_logits=(
+                        input_logits.reshape(-1).tolist()
+                        if input_logits is not None else []
+                    ),
                 )
             else:
                 gen_res = GenerateResult(token_id=token_id, finish_reason=finish_reason)
@@ -1,4 +1,5 @@
 import os
+import functools
 import importlib
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
@@ -15,26 +16,29 @@ from llm_perf.utils.logger import logger
 from llm_perf.model_zoo.llama2 import LlamaModel, LlamaDecoderLayer
 
 
-# get model impl from orig or vendor 
+# get model impl from orig or vendor
 def get_model_impl(
-    model_config: Dict[str, Any], 
+    model_config: Dict[str, Any],
     hardware_type: str
 ):
-    # for example, "ChatGLMForConditionalGeneration"
-    model_inferface = model_config["model_interface"]
-    model_name = model_config["model_name"]
-
-    # Get orig model
-    spec = importlib.util.spec_from_file_location(
-        model_name, f"llm_perf/model_zoo/{model_name.split('-')[0]}.py"
+    return _get_model_impl(
+        model_config["model_name"],
+        model_config["model_interface"],
+        hardware_type,
     )
-    base_module_impl = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(base_module_impl)
 
-    module = importlib.import_module(
-        f"llm_perf.model_zoo.llama2")
-    orig_model = getattr(module, "LlamaForCausalLM", None)
-    # orig_model = getattr(base_module_impl, model_inferface)
+
+@functools.lru_cache(maxsize=None)
+def _get_model_impl(
+    model_name: str,
+    model_inferface: str,
+    hardware_type: str
+):
+    # Get orig model, for example "ChatGLMForConditionalGeneration"
+    base_module_impl = importlib.import_module(
+        f"llm_perf.model_zoo.{model_name.split('-')[0]}"
+    )
+    orig_model = getattr(base_module_impl, model_inferface, None)
 
     # Get vendor model
     vendor_model_path = f"llm_perf/backends/{hardware_type}/model_impl"
@@ -176,7 +180,10 @@ class CoreEngine(ABC):
             raise ValueError(f'Unknown model name: {model_name}')
         
         model.eval()
-        model.half().cuda()
+        if model_name != 'llama2':
+            # llama2 is already cast and placed by deepspeed.init_inference above,
+            # another half().cuda() would re-walk every parameter
+            model.half().cuda()
         logger.info(f"cuda model {model_config['model_path']} loaded {model}")
 
         return model